@@ -18,9 +18,11 @@
 
 import argparse
 import btrfs
+import concurrent.futures
 import os
 import struct
 import sys
+import threading
 import types
 import zlib
 
@@ -52,6 +54,17 @@ def parse_args():
         type=int,
         help="Instead of a filesystem overview, show extents in a block group",
     )
+    parser.add_argument(
+        "--per-device",
+        action="store_true",
+        help="Also write a separate png file for each device (only for physical sort)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of devices to search concurrently (default: all of them)",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -368,37 +381,52 @@ def walk_chunks(fs, devices=None, order=None, size=None,
     return grid
 
 
-def walk_dev_extents(fs, devices=None, order=None, size=None,
-                     default_granularity=33554432, verbose=0, min_brightness=None, curve=None):
-    if devices is None:
-        devices = list(fs.devices())
-        dev_extents = fs.dev_extents()
-    else:
-        if isinstance(devices, types.GeneratorType):
-            devices = list(devices)
-        dev_extents = (dev_extent
-                       for device in devices
-                       for dev_extent in fs.dev_extents(device.devid, device.devid))
-
-    print("scope device {}".format(' '.join([str(device.devid) for device in devices])))
-    total_bytes = 0
-    device_grid_offset = {}
-    for device in devices:
-        device_grid_offset[device.devid] = total_bytes
-        total_bytes += device.total_bytes
-
-    grid = Grid(order, size, total_bytes, default_granularity, verbose, min_brightness, curve)
-    block_group_cache = {}
-    for dev_extent in dev_extents:
-        if dev_extent.vaddr in block_group_cache:
-            block_group = block_group_cache[dev_extent.vaddr]
-        else:
-            try:
-                block_group = fs.block_group(dev_extent.vaddr)
-            except IndexError:
-                continue
-            if block_group.flags & btrfs.BLOCK_GROUP_PROFILE_MASK != 0:
-                block_group_cache[dev_extent.vaddr] = block_group
+class _BlockGroupCache(object):
+    def __init__(self, fs):
+        self.fs = fs
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, vaddr):
+        with self._lock:
+            if vaddr in self._cache:
+                return self._cache[vaddr]
+        # Do the lookup without holding the lock, so other device walkers can
+        # keep going while we're waiting for the search ioctl.
+        block_group = self.fs.block_group(vaddr)
+        if block_group.flags & btrfs.BLOCK_GROUP_PROFILE_MASK != 0:
+            with self._lock:
+                self._cache[vaddr] = block_group
+        return block_group
+
+
+def _search_dev_extents(fs, device, block_group_cache):
+    result = []
+    for dev_extent in fs.dev_extents(device.devid, device.devid):
+        try:
+            block_group = block_group_cache.get(dev_extent.vaddr)
+        except IndexError:
+            continue
+        result.append((dev_extent, block_group))
+    return result
+
+
+def _search_dev_extents_parallel(fs, devices, jobs=None):
+    # The dev tree range of each device is independent of the others, and
+    # the search ioctl releases the GIL, so search all devices concurrently.
+    if len(devices) == 0:
+        return []
+    if jobs is None:
+        jobs = len(devices)
+    block_group_cache = _BlockGroupCache(fs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_search_dev_extents, fs, device, block_group_cache)
+                   for device in devices]
+        return [future.result() for future in futures]
+
+
+def _fill_dev_extents(grid, grid_offset, dev_extents, verbose):
+    for dev_extent, block_group in dev_extents:
         used_pct = block_group.used / block_group.length
         if verbose >= 1:
             print("dev_extent devid {0} paddr {1} length {2} pend {3} type {4} "
@@ -406,12 +434,61 @@ def walk_dev_extents(fs, devices=None, order=None, size=None,
                                             dev_extent.paddr + dev_extent.length - 1,
                                             btrfs.utils.block_group_flags_str(block_group.flags),
                                             used_pct * 100))
-        first_byte = device_grid_offset[dev_extent.devid] + dev_extent.paddr
+        first_byte = grid_offset + dev_extent.paddr
         grid.fill(first_byte, dev_extent.length, used_pct,
                   dev_extent_colors[block_group.flags & btrfs.BLOCK_GROUP_TYPE_MASK])
+
+
+def _walk_dev_extents(fs, devices=None, order=None, size=None,
+                      default_granularity=33554432, verbose=0, min_brightness=None, curve=None,
+                      jobs=None, combined=True, per_device=False):
+    if devices is None:
+        devices = list(fs.devices())
+    elif isinstance(devices, types.GeneratorType):
+        devices = list(devices)
+
+    print("scope device {}".format(' '.join([str(device.devid) for device in devices])))
+    dev_extents_per_device = _search_dev_extents_parallel(fs, devices, jobs)
+
+    grid = None
+    if combined:
+        total_bytes = sum(device.total_bytes for device in devices)
+        grid = Grid(order, size, total_bytes, default_granularity, verbose, min_brightness,
+                    curve)
+        grid_offset = 0
+        for device, dev_extents in zip(devices, dev_extents_per_device):
+            _fill_dev_extents(grid, grid_offset, dev_extents, verbose)
+            grid_offset += device.total_bytes
+
+    device_grids = []
+    if per_device:
+        for device, dev_extents in zip(devices, dev_extents_per_device):
+            print("scope device {}".format(device.devid))
+            device_grid = Grid(order, size, device.total_bytes, default_granularity, verbose,
+                               min_brightness, curve)
+            _fill_dev_extents(device_grid, 0, dev_extents, verbose)
+            device_grids.append((device, device_grid))
+
+    return grid, device_grids
+
+
+def walk_dev_extents(fs, devices=None, order=None, size=None,
+                     default_granularity=33554432, verbose=0, min_brightness=None, curve=None,
+                     jobs=None):
+    grid, _ = _walk_dev_extents(fs, devices, order, size, default_granularity, verbose,
+                                min_brightness, curve, jobs)
     return grid
 
 
+def walk_dev_extents_per_device(fs, devices=None, order=None, size=None,
+                                default_granularity=33554432, verbose=0, min_brightness=None,
+                                curve=None, jobs=None):
+    _, device_grids = _walk_dev_extents(fs, devices, order, size, default_granularity, verbose,
+                                        min_brightness, curve, jobs,
+                                        combined=False, per_device=True)
+    return device_grids
+
+
 def _get_metadata_root(extent):
     if extent.refs > 1:
         return btrfs.ctree.FS_TREE_OBJECTID
@@ -578,11 +655,17 @@ def main():
     filename_parts = ['fsid', fs.fsid]
     if args.curve != 'hilbert':
         filename_parts.append(args.curve)
+    if args.jobs is not None and args.jobs < 1:
+        raise HeatmapError("jobs ({}) must be at least 1".format(args.jobs))
     bg_vaddr = args.blockgroup
+    if args.per_device and (bg_vaddr is not None or args.sort != 'physical'):
+        raise HeatmapError("--per-device can only be used with physical sort")
+    device_grids = []
     if bg_vaddr is None:
         if args.sort == 'physical':
-            grid = walk_dev_extents(fs, order=args.order, size=args.size, verbose=verbose,
-                                    curve=args.curve)
+            grid, device_grids = _walk_dev_extents(fs, order=args.order, size=args.size,
+                                                   verbose=verbose, curve=args.curve,
+                                                   jobs=args.jobs, per_device=args.per_device)
         elif args.sort == 'virtual':
             filename_parts.append('chunks')
             grid = walk_chunks(fs, order=args.order, size=args.size, verbose=verbose,
@@ -598,7 +681,15 @@ def main():
                             curve=args.curve)
         filename_parts.extend(['blockgroup', block_group.vaddr])
 
-    grid.write_png(generate_png_file_name(args.output, filename_parts))
+    grid.write_png(generate_png_file_name(args.output, list(filename_parts)))
+    for device, device_grid in device_grids:
+        if args.output is not None and not os.path.isdir(args.output):
+            root, ext = os.path.splitext(args.output)
+            pngfile = "{}_device_{}{}".format(root, device.devid, ext)
+        else:
+            pngfile = generate_png_file_name(args.output,
+                                             filename_parts + ['device', device.devid])
+        device_grid.write_png(pngfile)
 
 
 if __name__ == '__main__':